@@ -0,0 +1,75 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision.datasets import CIFAR100, CIFAR10
+
+class TensorCIFARMixin(object):
+    """Serves CIFAR images as uint8 CHW tensors instead of PIL images
+
+    The decoded images are kept in a single [N,32,32,3] uint8 tensor sharing
+    memory with the numpy array loaded by torchvision, so forked loader
+    workers read it copy-on-write and __getitem__ never goes through PIL.
+    Transforms therefore have to accept tensors rather than PIL images; without
+    any, batches stay uint8 and can be augmented on the GPU with GPUAugment.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TensorCIFARMixin, self).__init__(*args, **kwargs)
+        self.images = torch.from_numpy(self.data)
+        # labels as a tensor too, so every field of a collated batch is a
+        # tensor that the loader's pin_memory stage pins
+        self.labels = torch.tensor(self.targets, dtype=torch.long)
+
+    def __getitem__(self, index):
+        img = self.images[index].permute(2, 0, 1)
+        target = self.labels[index]
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target
+
+
+class TensorCIFAR10(TensorCIFARMixin, CIFAR10):
+    pass
+
+
+class TensorCIFAR100(TensorCIFARMixin, CIFAR100):
+    pass
+
+
+class GPUAugment(nn.Module):
+    """Batched CIFAR augmentation and normalization on the GPU
+
+    Takes the uint8 [N,3,H,W] batch straight from the loader. In training mode
+    every image is zero-padded, randomly cropped back to HxW and randomly
+    flipped horizontally with one gather over the whole batch; in eval mode it
+    is only normalized. The output is float and channels_last.
+    """
+    def __init__(self, mean, std, padding=4):
+        super(GPUAugment, self).__init__()
+        self.padding = padding
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1) * 255)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1) * 255)
+
+    def forward(self, input):
+        if self.training:
+            n, _, h, w = input.shape
+            p = self.padding
+            padded = F.pad(input, (p, p, p, p))
+
+            offset = torch.randint(0, 2 * p + 1, (2, n, 1), device=input.device)
+            rows = offset[0] + torch.arange(h, device=input.device)
+            cols = offset[1] + torch.arange(w, device=input.device)
+            flip = torch.rand(n, 1, device=input.device) < 0.5
+            cols = torch.where(flip, cols.flip(1), cols)
+
+            # advanced indexing around the channel slice yields [N,H,W,C], so
+            # the permute back to NCHW is already channels_last
+            batch = torch.arange(n, device=input.device).view(n, 1, 1)
+            input = padded[batch, :, rows.unsqueeze(2), cols.unsqueeze(1)].permute(0, 3, 1, 2)
+
+        input = (input.float() - self.mean) / self.std
+        return input.contiguous(memory_format=torch.channels_last)
@@ -1,20 +1,25 @@
 import argparse
+import math
 import os
+import queue
 import random
 import shutil
+import threading
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks as dh
 import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.transforms as transforms
 import resnet_lst_cifar as rr
-from torchvision.datasets import CIFAR100, CIFAR10
+from cifar_tensor import TensorCIFAR100, TensorCIFAR10, GPUAugment
 
 model_names = sorted(name for name in rr.__dict__
     if name.islower() and not name.startswith("__")
@@ -26,8 +31,9 @@ parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet164_lst_cifar
                     help='model architecture: ' +
                         ' | '.join(model_names) +
                         ' (default: resnet164_lst_cifar)')
-parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
-                    help='number of data loading workers (default: 8)')
+parser.add_argument('-j', '--workers', default=None, type=int, metavar='N',
+                    help='number of data loading workers per process '
+                         '(default: CPU cores per process, at most 16)')
 parser.add_argument('--epochs', default=160, type=int, metavar='N',
                     help='number of total epochs to run (default: 160)')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -36,6 +42,9 @@ parser.add_argument('-b', '--batch-size', default=128, type=int,
                     metavar='N', help='mini-batch size (default: 128)')
 parser.add_argument('--lr', '--learning-rate', default=0.1, type=float,
                     metavar='LR', help='initial learning rate')
+parser.add_argument('--lr-schedule', default='step', choices=['step', 'cosine'],
+                    help='learning rate schedule: step decay by 10x after epochs 81 and 122, '
+                         'or cosine annealing over --epochs (default: step)')
 parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
                     help='momentum')
 parser.add_argument('--weight-decay', '--wd', default=5e-4, type=float,
@@ -46,18 +55,22 @@ parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
+parser.add_argument('--no-compile', dest='compile', action='store_false',
+                    help='run the model eagerly instead of through torch.compile')
 parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('--world-size', default=1, type=int,
-                    help='number of distributed processes')
-parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
+                    help='number of nodes for distributed training')
+parser.add_argument('--rank', default=0, type=int,
+                    help='node rank for distributed training')
+parser.add_argument('--dist-url', default='tcp://127.0.0.1:23456', type=str,
                     help='url used to set up distributed training')
-parser.add_argument('--dist-backend', default='gloo', type=str,
-                    help='distributed backend')
+parser.add_argument('--dist-backend', default='nccl', type=str,
+                    help='distributed backend (default: nccl)')
 parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
-                    help='GPU id to use.')
+                    help='GPU id to use. If set, trains on this single GPU without DDP.')
 parser.add_argument('--ctype', default=100, type=int, help='100(CIFAR-100, default) or 10(CIFAR-10)')
 parser.add_argument('--output_dir', default='./', type=str, help='where to save the model (default: current directory)')
 parser.add_argument('--lst_k',default=3,type=int, help='kernel size used in T_s (default: 3)')
@@ -67,13 +80,9 @@ parser.add_argument('--tau', default=1e-4, type=float, help='threshold for ST (d
 best_prec1 = 0
 
 def main():
-    global args, best_prec1
     args = parser.parse_args()
 
     if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        cudnn.deterministic = True
         warnings.warn('You have chosen to seed training. '
                       'This will turn on the CUDNN deterministic setting, '
                       'which can slow down your training considerably! '
@@ -84,179 +93,266 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
-    args.distributed = args.world_size > 1
+    args.distributed = args.gpu is None
+
+    ngpus_per_node = torch.cuda.device_count()
+    if args.distributed:
+        # one process per GPU, world_size becomes the total number of processes
+        args.world_size = ngpus_per_node * args.world_size
+        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args))
+    else:
+        main_worker(args.gpu, ngpus_per_node, args)
+
+
+def main_worker(gpu, ngpus_per_node, main_args):
+    global args, best_prec1
+    args = main_args
+    args.gpu = gpu
+    torch.cuda.set_device(args.gpu)
+
+    # seed inside the worker, spawned processes do not inherit the RNG state
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        cudnn.deterministic = True
 
     if args.distributed:
+        args.rank = args.rank * ngpus_per_node + gpu
         dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
-                                world_size=args.world_size)
+                                world_size=args.world_size, rank=args.rank)
+        # split the batch across the GPUs of this node
+        args.batch_size = args.batch_size // ngpus_per_node
+    if args.workers is None:
+        # share the cores of this node between its training processes, more
+        # than 16 workers only adds contention for 32x32 images
+        nprocs = ngpus_per_node if args.distributed else 1
+        args.workers = min((os.cpu_count() or 1) // max(1, nprocs), 16)
+    args.main_process = not args.distributed or args.rank == 0
+    # the first process on each node downloads the dataset, the others wait
+    args.local_main = not args.distributed or gpu == 0
 
     # create model
     #print(len(glob.glob(os.path.join(args.data, 'train', '*/'))))
-    if args.pretrained:
-        print("=> using pre-trained model '{}'".format(args.arch))
-    else:
-        print("=> creating model '{}'".format(args.arch))
+    if args.main_process:
+        if args.pretrained:
+            print("=> using pre-trained model '{}'".format(args.arch))
+        else:
+            print("=> creating model '{}'".format(args.arch))
 
-    if not(os.path.exists(args.output_dir)):
-        os.mkdir(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     fid_train = open(os.path.join(args.output_dir, 'train.txt'), 'at+')
     fid_val = open(os.path.join(args.output_dir, 'val.txt'), 'at+')
-    
-    model = rr.__dict__[args.arch](num_classes=args.ctype, k=args.lst_k, a=args.lst_a, tau=args.tau)
+    logger = BackgroundLogger()
 
-    if args.gpu is not None:
-        model = model.cuda(args.gpu)
-    elif args.distributed:
-        model.cuda()
-        model = torch.nn.parallel.DistributedDataParallel(model)
-    else:
-        if args.arch.startswith('alexnet') or args.arch.startswith('vgg'):
-            model.features = torch.nn.DataParallel(model.features)
-            model.cuda()
-        else:
-            model = torch.nn.DataParallel(model).cuda()
-
-    # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda(args.gpu)
-
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
-
-    # optionally resume from a checkpoint
-    if args.resume:
-        if os.path.isfile(args.resume):
-            print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            args.start_epoch = checkpoint['epoch']
-            best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
-        else:
-            print("=> no checkpoint found at '{}'".format(args.resume))
-
-    cudnn.benchmark = True
-
-    # Data loading code
-    if args.ctype == 10:
-        # Cifar-10 normalize
-        normalize = transforms.Normalize(mean=[0.4914, 0.4822, 0.4465], std=[0.2023, 0.1994, 0.2010])
-        cifar_class = CIFAR10
-    elif args.ctype == 100:
-        # Cifar-100 normalize
-        normalize = transforms.Normalize(mean=[0.5071, 0.4867, 0.4408], std=[0.2675, 0.2565, 0.2761])
-        cifar_class = CIFAR100
-    else:
-        print('Unknown CIFAR type!')
-        return
-    
-    train_dataset = cifar_class(
-        root=args.output_dir,
-        train=True,
-        download=True,
-        transform=transforms.Compose([
-            transforms.RandomCrop(32, padding=4),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ]))
-
-    test_dataset = cifar_class(
-        root=args.output_dir,
-        train=False,
-        download=True,
-        transform=transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
-        ]))
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-    else:
-        train_sampler = None
-    
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler)
-
-    val_loader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
-    
-    if args.evaluate:
-        validate(val_loader, model, criterion, fid_val)
-        return
-
-    for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            train_sampler.set_epoch(epoch)
-        adjust_learning_rate(optimizer, epoch)
+    try:
+        model = rr.__dict__[args.arch](num_classes=args.ctype, k=args.lst_k, a=args.lst_a, tau=args.tau)
 
-        # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, fid_train)
+        model = model.cuda(args.gpu).to(memory_format=torch.channels_last)
+        if args.distributed:
+            # the graph is identical every step, so DDP can reuse its bucket order and
+            # let gradients alias the allreduce buckets instead of being copied into them
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu],
+                                                              output_device=args.gpu,
+                                                              gradient_as_bucket_view=True,
+                                                              static_graph=True,
+                                                              bucket_cap_mb=50)
+            # send gradients as fp16 during allreduce to halve the communication volume
+            model.register_comm_hook(state=None, hook=dh.fp16_compress_hook)
+        if args.compile:
+            # compile after wrapping so dynamo splits the graph at DDP bucket
+            # boundaries and allreduce overlaps with the backward
+            model.compile(mode='max-autotune')
+
+        # define loss function (criterion) and optimizer
+        criterion = nn.CrossEntropyLoss().cuda(args.gpu)
+
+        # fused=True applies the update to all parameters in a single kernel
+        optimizer = torch.optim.SGD(model.parameters(), args.lr,
+                                    momentum=args.momentum,
+                                    weight_decay=args.weight_decay,
+                                    fused=True)
+
+        scaler = torch.amp.GradScaler('cuda')
+
+        # optionally resume from a checkpoint
+        if args.resume:
+            if os.path.isfile(args.resume):
+                if args.main_process:
+                    print("=> loading checkpoint '{}'".format(args.resume))
+                checkpoint = torch.load(args.resume, map_location='cuda:{}'.format(args.gpu))
+                args.start_epoch = checkpoint['epoch']
+                best_prec1 = checkpoint['best_prec1']
+                model.load_state_dict(checkpoint['state_dict'])
+                optimizer.load_state_dict(checkpoint['optimizer'])
+                if 'scaler' in checkpoint:
+                    scaler.load_state_dict(checkpoint['scaler'])
+                if args.main_process:
+                    print("=> loaded checkpoint '{}' (epoch {})"
+                          .format(args.resume, checkpoint['epoch']))
+            elif args.main_process:
+                print("=> no checkpoint found at '{}'".format(args.resume))
+
+        cudnn.benchmark = True
+
+        # Data loading code
+        if args.ctype == 10:
+            # Cifar-10 normalize
+            augment = GPUAugment(mean=[0.4914, 0.4822, 0.4465], std=[0.2023, 0.1994, 0.2010])
+            cifar_class = TensorCIFAR10
+        elif args.ctype == 100:
+            # Cifar-100 normalize
+            augment = GPUAugment(mean=[0.5071, 0.4867, 0.4408], std=[0.2675, 0.2565, 0.2761])
+            cifar_class = TensorCIFAR100
+        else:
+            print('Unknown CIFAR type!')
+            return
+        # crop, flip and normalize are applied per batch on the GPU, the loaders
+        # only ship uint8 images
+        augment = augment.cuda(args.gpu)
 
-        # evaluate on validation set
-        prec1 = validate(val_loader, model, criterion, fid_val)
+        if args.distributed and not args.local_main:
+            dist.barrier()
 
-        # remember best prec@1 and save checkpoint
-        is_best = prec1 > best_prec1
-        best_prec1 = max(prec1, best_prec1)
-        save_checkpoint({
-            'epoch': epoch + 1,
-            'arch': args.arch,
-            'state_dict': model.state_dict(),
-            'best_prec1': best_prec1,
-            'optimizer' : optimizer.state_dict(),
-        }, is_best, args.output_dir)
+        train_dataset = cifar_class(
+            root=args.output_dir,
+            train=True,
+            download=True)
 
-    fid_train.close()
-    fid_val.close()
+        test_dataset = cifar_class(
+            root=args.output_dir,
+            train=False,
+            download=True)
 
+        if args.distributed and args.local_main:
+            dist.barrier()
 
-def train(train_loader, model, criterion, optimizer, epoch, fid_train):
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+            # every process scores its own shard, validate() sums the results
+            val_sampler = torch.utils.data.distributed.DistributedSampler(test_dataset, shuffle=False)
+        else:
+            train_sampler = None
+            val_sampler = None
+
+        loader_kwargs = dict(num_workers=args.workers, pin_memory=True)
+        if args.workers > 0:
+            # keep the workers alive across epochs and let them run further ahead
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+        # drop the last incomplete batch so every training step has the same shape
+        # and cudnn.benchmark / torch.compile never re-tune for a leftover batch
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+            sampler=train_sampler, drop_last=True, **loader_kwargs)
+
+        val_loader = torch.utils.data.DataLoader(
+            test_dataset,
+            batch_size=args.batch_size, shuffle=False, sampler=val_sampler, **loader_kwargs)
+
+        if args.evaluate:
+            validate(val_loader, model, augment, criterion, logger, fid_val)
+            return
+
+        lr_schedule = build_lr_schedule()
+
+        # checkpoints are written by a background thread from a CPU snapshot, so
+        # the next epoch can start while the previous one is being serialized
+        checkpoint_saver = ThreadPoolExecutor(max_workers=1)
+        pending_save = None
+
+        for epoch in range(args.start_epoch, args.epochs):
+            if args.distributed:
+                train_sampler.set_epoch(epoch)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr_schedule[epoch]
+
+            # train for one epoch
+            train(train_loader, model, augment, criterion, optimizer, scaler, epoch, logger, fid_train)
+
+            # evaluate on validation set
+            prec1 = validate(val_loader, model, augment, criterion, logger, fid_val)
+
+            # remember best prec@1 and save checkpoint
+            is_best = prec1 > best_prec1
+            best_prec1 = max(prec1, best_prec1)
+            if args.main_process:
+                state = state_to_cpu({
+                    'epoch': epoch + 1,
+                    'arch': args.arch,
+                    'state_dict': model.state_dict(),
+                    'best_prec1': best_prec1,
+                    'optimizer' : optimizer.state_dict(),
+                    'scaler' : scaler.state_dict(),
+                })
+                if pending_save is not None:
+                    pending_save.result()
+                pending_save = checkpoint_saver.submit(save_checkpoint, state, is_best, args.output_dir)
+
+        if pending_save is not None:
+            pending_save.result()
+        checkpoint_saver.shutdown()
+    finally:
+        # drain pending log lines even if training fails
+        logger.close()
+        fid_train.close()
+        fid_val.close()
+
+
+def train(train_loader, model, augment, criterion, optimizer, scaler, epoch, logger, fid_train):
     batch_time = AverageMeter()
     data_time = AverageMeter()
 
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    losses = BufferedAverageMeter()
+    topk = TopkMeter((1, 5), device=args.gpu)
+    top1, top5 = topk.meters
 
     # switch to train mode
     model.train()
+    augment.train()
+
+    # batch time comes from CUDA events and loss/accuracy stay on the device
+    # until the next print, so the loop never waits for the GPU in between
+    tic = torch.cuda.Event(enable_timing=True)
+    tic.record()
+    last_i = -1
 
     end = time.time()
     for i, (input, target) in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        if args.gpu is not None:
-            input = input.cuda(args.gpu, non_blocking=True)
+        input = augment(input.cuda(args.gpu, non_blocking=True))
         target = target.cuda(args.gpu, non_blocking=True)
 
         # compute output
-        output = model(input)
-
-        loss = criterion(output, target)
+        with torch.autocast('cuda'):
+            output = model(input)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        losses.push(loss, input.size(0))
+        topk.push(output, target)
 
         # compute gradient and do SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
         end = time.time()
 
         if i % args.print_freq == 0:
+            # measure elapsed time
+            toc = torch.cuda.Event(enable_timing=True)
+            toc.record()
+            toc.synchronize()
+            batch_time.update(tic.elapsed_time(toc) / 1000.0 / (i - last_i), i - last_i)
+            for meter in (losses, topk):
+                meter.flush()
+            tic, last_i = toc, i
+
+        if i % args.print_freq == 0 and args.main_process:
             str_arr = 'Loss {l.val:.4f} ({l.avg:.4f})\tTop1 {top1.val:.3f} ({top1.avg:.3f})\tTop5 {top5.val:.3f} ({top5.avg:.3f})'.format(l=losses, top1=top1, top5=top5) 
 
             msg = 'Epoch: [{0}][{1}/{2}]\tTime {batch_time.val:.3f} ({batch_time.avg:.3f})\tData {data_time.val:.3f} ({data_time.avg:.3f})\t'.format(
@@ -264,67 +360,109 @@ def train(train_loader, model, criterion, optimizer, epoch, fid_train):
                   batch_time=batch_time,
                   data_time=data_time) + str_arr
 
-            print(msg)
-
-            fid_train.write(msg + '\n')
-            fid_train.flush()
+            logger.log(msg, fid_train)
 
 
-def validate(val_loader, model, criterion, fid_val):
+def validate(val_loader, model, augment, criterion, logger, fid_val):
     batch_time = AverageMeter()
 
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    losses = BufferedAverageMeter()
+    topk = TopkMeter((1, 5), device=args.gpu)
+    top1, top5 = topk.meters
 
     # switch to evaluate mode
     model.eval()
+    augment.eval()
+
+    # DistributedSampler pads the shards to equal length by repeating samples;
+    # those come last in a shard and are left out of the statistics
+    if args.distributed:
+        num_samples = len(range(args.rank, len(val_loader.dataset), args.world_size))
+    else:
+        num_samples = len(val_loader.dataset)
+    seen = 0
 
     with torch.no_grad():
-        end = time.time()
+        tic = torch.cuda.Event(enable_timing=True)
+        tic.record()
+        last_i = -1
+
         for i, (input, target) in enumerate(val_loader):
-            if args.gpu is not None:
-                input = input.cuda(args.gpu, non_blocking=True)
+            input = augment(input.cuda(args.gpu, non_blocking=True))
             target = target.cuda(args.gpu, non_blocking=True)
-            
+            n = min(input.size(0), num_samples - seen)
+            seen += n
+
             # compute output
-            output = model(input)
-            loss = criterion(output, target)
+            with torch.autocast('cuda'):
+                output = model(input)[:n]
+                loss = criterion(output, target[:n])
 
             # measure accuracy and record loss
-            prec1, prec5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), input.size(0))
-            top1.update(prec1[0], input.size(0))
-            top5.update(prec5[0], input.size(0))
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
+            if n > 0:
+                losses.push(loss, n)
+                topk.push(output, target[:n])
 
             if i % args.print_freq == 0:
+                # measure elapsed time
+                toc = torch.cuda.Event(enable_timing=True)
+                toc.record()
+                toc.synchronize()
+                batch_time.update(tic.elapsed_time(toc) / 1000.0 / (i - last_i), i - last_i)
+                for meter in (losses, topk):
+                    meter.flush()
+                tic, last_i = toc, i
+
+            if i % args.print_freq == 0 and args.main_process:
 
                 str_arr = 'Loss {l.val:.4f} ({l.avg:.4f})\tTop1 {t1.val:.3f} ({t1.avg:.3f})\tTop5 {t5.val:.3f} ({t5.avg:.3f})'.format(l=losses, t1=top1, t5=top5)
 
                 msg = 'Test: [{0}/{1}]\tTime {batch_time.val:.3f} ({batch_time.avg:.3f})\t'.format(
                       i, len(val_loader), batch_time=batch_time) + str_arr
 
+                logger.log(msg)
 
-                print(msg)
+        for meter in (losses, topk):
+            meter.flush()
+
+        if args.distributed:
+            all_reduce_meters([losses, top1, top5])
 
-        msg = 'T1 {t1.avg:.3f} T5 {t5.avg:.3f}'.format(t1=top1,t5=top5)
-        print('-'*32)
-        print(msg)
-        print('-'*32)
-        fid_val.write(msg + '\n')
-        fid_val.flush()
+        if args.main_process:
+            msg = 'T1 {t1.avg:.3f} T5 {t5.avg:.3f}'.format(t1=top1,t5=top5)
+            logger.log('-'*32)
+            logger.log(msg, fid_val)
+            logger.log('-'*32)
 
     return top1.avg
 
 
 def save_checkpoint(state, is_best, output_dir, filename='checkpoint.pth.tar'):
-    torch.save(state, os.path.join(output_dir, filename))
+    path = os.path.join(output_dir, filename)
+    # write to a new file and rename it, so a model_best hard link to the
+    # previous checkpoint is never overwritten in place
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
     if is_best:
-        shutil.copyfile(os.path.join(output_dir, filename), os.path.join(output_dir, 'model_best.pth.tar'))
+        best_path = os.path.join(output_dir, 'model_best.pth.tar')
+        if os.path.lexists(best_path + '.tmp'):
+            os.remove(best_path + '.tmp')
+        try:
+            os.link(path, best_path + '.tmp')
+        except OSError:
+            # the filesystem does not support hard links
+            shutil.copyfile(path, best_path + '.tmp')
+        os.replace(best_path + '.tmp', best_path)
+
+def state_to_cpu(state):
+    """Copies every tensor in a (nested) checkpoint dict to host memory"""
+    if torch.is_tensor(state):
+        return state.detach().cpu()
+    if isinstance(state, dict):
+        return {k: state_to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -343,33 +481,119 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-def adjust_learning_rate(optimizer, epoch):
-    """Adjust the learning rate"""
-    if epoch <=81:
-        lr = args.lr
-    elif epoch <=122:
-        lr = args.lr * 0.1
-    else:
-        lr = args.lr * 0.01
-
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-def accuracy(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
+def all_reduce_meters(meters):
+    """Sums meters over all processes, so avg covers every process's samples"""
+    totals = torch.tensor([[m.sum, m.count] for m in meters],
+                          dtype=torch.float64, device=args.gpu)
+    dist.all_reduce(totals)
+    for m, (total, count) in zip(meters, totals.tolist()):
+        m.sum = total
+        m.count = count
+        m.avg = total / count
+
+class BufferedAverageMeter(AverageMeter):
+    """Averages device scalars, copying them to the host only on flush()"""
+    def reset(self):
+        super(BufferedAverageMeter, self).reset()
+        self.buf = []
+        self.buf_n = []
+
+    def push(self, val, n=1):
+        self.buf.append(val.detach())
+        self.buf_n.append(n)
+
+    def flush(self):
+        if not self.buf:
+            return
+        total = sum(self.buf_n)
+        vals = torch.stack(self.buf).float().tolist()
+        self.update(sum(v * n for v, n in zip(vals, self.buf_n)) / total, total)
+        self.buf = []
+        self.buf_n = []
+
+class TopkMeter(object):
+    """Keeps top-k hit counts on the device and turns them into precisions on flush()"""
+    def __init__(self, topk=(1,), device=None):
+        self.topk = topk
+        self.meters = [AverageMeter() for _ in topk]
+        self.correct = torch.zeros(len(topk), dtype=torch.long, device=device)
+        self.n = 0
+
+    def push(self, output, target):
+        self.correct += accuracy_counts(output, target, self.topk)
+        self.n += target.size(0)
+
+    def flush(self):
+        if self.n == 0:
+            return
+        for meter, correct in zip(self.meters, self.correct.tolist()):
+            meter.update(correct * 100.0 / self.n, self.n)
+        self.correct.zero_()
+        self.n = 0
+
+class BackgroundLogger(object):
+    """Prints messages and appends them to log files from a daemon thread
+
+    The training loop only enqueues messages; the thread does the console and
+    file I/O and flushes the files at most every flush_interval seconds.
+    """
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, msg, fid=None):
+        self.queue.put((msg, fid))
+
+    def close(self):
+        """Writes out all pending messages and stops the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        dirty = set()
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                msg, fid = item
+                print(msg)
+                if fid is not None:
+                    fid.write(msg + '\n')
+                    dirty.add(fid)
+            if time.time() - last_flush >= self.flush_interval:
+                for fid in dirty:
+                    fid.flush()
+                dirty.clear()
+                last_flush = time.time()
+        for fid in dirty:
+            fid.flush()
+
+def build_lr_schedule():
+    """Precomputes the learning rate of every epoch"""
+    if args.lr_schedule == 'cosine':
+        return [args.lr * 0.5 * (1 + math.cos(math.pi * epoch / args.epochs))
+                for epoch in range(args.epochs)]
+
+    return [args.lr * (1.0 if epoch <= 81 else 0.1 if epoch <= 122 else 0.01)
+            for epoch in range(args.epochs)]
+
+def accuracy_counts(output, target, topk=(1,)):
+    """Counts the samples whose target is among the top-k predictions, on the device"""
     with torch.no_grad():
         maxk = max(topk)
-        batch_size = target.size(0)
 
         _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-        res = []
-        for k in topk:
-            correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
+        # hits per rank, accumulated so entry k-1 counts the top-k hits
+        hits = pred.eq(target.unsqueeze(1)).sum(0).cumsum(0)
+
+        return torch.stack([hits[k-1] for k in topk])
 
 
 if __name__ == '__main__':